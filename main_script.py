@@ -1,20 +1,183 @@
 import streamlit as st
 import json
 import pymupdf as fitz  # PyMuPDF
-from openai import OpenAI
+try:
+    import pypdfium2 as pdfium  # faster plain-text extraction; fall back to PyMuPDF if absent
+except ImportError:
+    pdfium = None
+from openai import OpenAI, AsyncOpenAI, RateLimitError, APIConnectionError, APITimeoutError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 from googletrans import Translator
+import numpy as np
+import tiktoken
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import time
 import tempfile
-import io
+import shutil
 import hashlib
+import random
+import sqlite3
 import os
 import re
 
 # -------------------------------
 # INITIALIZATION
 # -------------------------------
-client = OpenAI()
-translator = Translator()
+@st.cache_resource(show_spinner=False)
+def get_openai_client():
+    """One OpenAI client (and its connection pool) shared across reruns and sessions."""
+    return OpenAI()
+
+@st.cache_resource(show_spinner=False)
+def get_async_openai_client():
+    return AsyncOpenAI()
+
+@st.cache_resource(show_spinner=False)
+def get_translator():
+    return Translator()
+
+client = get_openai_client()
+aclient = get_async_openai_client()
+translator = get_translator()
+
+MAX_CONCURRENT_OPENAI_CALLS = 5  # stay under tier-1 rate limits
+
+_CODE_FENCE_RE = re.compile(r"```(?:json)?|```")
+
+def _strip_code_fences(raw):
+    """Remove markdown code fences from a model response before json.loads."""
+    return _CODE_FENCE_RE.sub("", raw).strip()
+
+def _parse_json_items(raw):
+    """Parse a JSON-mode response, unwrapping the {"items": [...]} envelope."""
+    parsed = json.loads(_strip_code_fences(raw))
+    if isinstance(parsed, dict):
+        return parsed.get("items", [])
+    return parsed
+
+@retry(
+    wait=wait_exponential_jitter(initial=1, max=30),
+    retry=retry_if_exception_type((RateLimitError, APIConnectionError, APITimeoutError)),
+    stop=stop_after_attempt(6),
+    reraise=True,
+)
+def _chat_completion(**kwargs):
+    """Chat-completion wrapper: transient 429s and connection blips retry with backoff."""
+    return client.chat.completions.create(**kwargs)
+
+@retry(
+    wait=wait_exponential_jitter(initial=1, max=30),
+    retry=retry_if_exception_type((RateLimitError, APIConnectionError, APITimeoutError)),
+    stop=stop_after_attempt(6),
+    reraise=True,
+)
+async def _achat_completion(**kwargs):
+    """Async twin of _chat_completion with the same backoff policy."""
+    return await aclient.chat.completions.create(**kwargs)
+
+@retry(
+    wait=wait_exponential_jitter(initial=1, max=30),
+    retry=retry_if_exception_type((RateLimitError, APIConnectionError, APITimeoutError)),
+    stop=stop_after_attempt(6),
+    reraise=True,
+)
+def _create_embedding(**kwargs):
+    """Embeddings wrapper sharing the chat calls' backoff policy."""
+    return client.embeddings.create(**kwargs)
+
+@retry(
+    wait=wait_exponential_jitter(initial=1, max=30),
+    retry=retry_if_exception_type((RateLimitError, APIConnectionError, APITimeoutError)),
+    stop=stop_after_attempt(6),
+    reraise=True,
+)
+def _create_transcription(**kwargs):
+    """Transcription wrapper sharing the chat calls' backoff policy."""
+    return client.audio.transcriptions.create(**kwargs)
+
+@st.cache_data(show_spinner=False)
+def transcribe_audio(audio_hash, _audio_bytes):
+    """Transcribe a recording once per unique content hash.
+
+    Keyed on the hash only (the bytes are underscore-skipped) so re-recording
+    an identical clip — even for a different question — never hits Whisper
+    twice.
+    """
+    transcription = _create_transcription(
+        model="whisper-1",
+        file=("answer.wav", _audio_bytes, "audio/wav")
+    )
+    return getattr(transcription, "text", "").strip()
+
+LLM_CACHE_TTL_SECONDS = 86400
+
+def _llm_cache_get(request_hash):
+    try:
+        row = _translation_cache_db().execute(
+            "SELECT response, created FROM llm_responses WHERE request_hash = ?",
+            (request_hash,)
+        ).fetchone()
+        if row and time.time() - row[1] < LLM_CACHE_TTL_SECONDS:
+            return row[0]
+    except Exception:
+        pass
+    return None
+
+def _llm_cache_put(request_hash, response_text):
+    try:
+        db = _translation_cache_db()
+        db.execute(
+            "INSERT OR REPLACE INTO llm_responses (request_hash, response, created) VALUES (?, ?, ?)",
+            (request_hash, response_text, time.time())
+        )
+        db.commit()
+    except Exception:
+        pass
+
+def _chat_completion_text(on_delta=None, **kwargs):
+    """Chat completion returning the message text.
+
+    temperature=0 requests are deterministic, so identical (model, messages)
+    pairs are served from an exact-match SHA-256 disk cache instead of
+    re-paying the API call. Sampled (temperature>0) requests bypass the cache.
+
+    If on_delta is given the request streams, calling on_delta(buffer) with the
+    accumulated text every ~200 characters so the UI can show progress while
+    tokens arrive. Cache hits return at once without streaming.
+    """
+    request_hash = None
+    if kwargs.get("temperature") == 0 and not kwargs.get("stream"):
+        payload = {
+            "model": kwargs.get("model"),
+            "messages": kwargs.get("messages"),
+            "temperature": 0,
+        }
+        request_hash = hashlib.sha256(
+            json.dumps(payload, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+        cached = _llm_cache_get(request_hash)
+        if cached is not None:
+            return cached
+    if on_delta is None:
+        response = _chat_completion(**kwargs)
+        text = response.choices[0].message.content
+    else:
+        stream = _chat_completion(stream=True, **kwargs)
+        parts = []
+        pending = 0
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                delta = chunk.choices[0].delta.content
+                parts.append(delta)
+                pending += len(delta)
+                if pending >= 200:  # batch UI updates to avoid rerender storms
+                    on_delta("".join(parts))
+                    pending = 0
+        text = "".join(parts)
+    if request_hash is not None:
+        _llm_cache_put(request_hash, text)
+    return text
 
 st.set_page_config(
     page_title="📘 Multilingual Oral Board Exam Trainer",
@@ -64,75 +227,76 @@ def _looks_english(text):
     hits = sum(word in text.lower() for word in english_words)
     return hits >= 2
 
+def _gpt_translation_instructions(target_language_name, target_language_code):
+    """Static translation instructions, used as a cacheable system-message prefix.
+
+    Ukrainian gets clinician-specific instructions."""
+    if target_language_code == "uk":
+        return f"""
+        You are a professional medical translator and Ukrainian-speaking clinician.
+
+        TASK:
+        Translate the following medical exam content into NATURAL, CLINICALLY CORRECT UKRAINIAN.
+
+        TARGET STYLE:
+        - Ukrainian as used by medical residents in Ukraine
+        - Natural Ukrainian syntax (not word-for-word English)
+        - Clear, concise, exam-appropriate phrasing
+
+        TERMINOLOGY RULES:
+        - Use standard Ukrainian medical terminology where it exists
+        - If a term is commonly used in English/Latin in Ukrainian practice, keep it (e.g. CT, MRI, sepsis)
+        - Do NOT invent rare or archaic Ukrainian equivalents
+        - Do NOT translate proper disease names unnecessarily
+
+        QUALITY RULES:
+        - Preserve the full clinical meaning
+        - Minor rephrasing is allowed to improve clarity
+        - Avoid literal English word order
+        - Avoid Russian-style constructions
+
+        OUTPUT RULES:
+        - Output ONLY Ukrainian
+        - No English
+        - No explanations
+        - No quotes
+
+        """
+    return f"""
+    You are a professional medical translator.
+
+    TASK:
+    Translate the following medical text into **{target_language_name}**.
+
+    STRICT RULES:
+    - Output MUST be written entirely in {target_language_name}
+    - DO NOT keep English sentences
+    - Medical terms may remain Latin-based if appropriate
+    - Do NOT summarize or paraphrase
+    - If unsure, still translate
+    - DO NOT write in English
+    """
+
 @st.cache_data(show_spinner=False)
 def safe_translate(text, target_language_name):
     """Translate text safely with fallback to google translate and skip English."""
     if not text or not text.strip():
         return text
-                
+
     # ✅ Skip translation for English
     if target_language_code == "en":
         return text
     try:
-        if target_language_code == "uk":
-            prompt = f"""
-            You are a professional medical translator and Ukrainian-speaking clinician.
-            
-            TASK:
-            Translate the following medical exam content into NATURAL, CLINICALLY CORRECT UKRAINIAN.
-            
-            TARGET STYLE:
-            - Ukrainian as used by medical residents in Ukraine
-            - Natural Ukrainian syntax (not word-for-word English)
-            - Clear, concise, exam-appropriate phrasing
-            
-            TERMINOLOGY RULES:
-            - Use standard Ukrainian medical terminology where it exists
-            - If a term is commonly used in English/Latin in Ukrainian practice, keep it (e.g. CT, MRI, sepsis)
-            - Do NOT invent rare or archaic Ukrainian equivalents
-            - Do NOT translate proper disease names unnecessarily
-            
-            QUALITY RULES:
-            - Preserve the full clinical meaning
-            - Minor rephrasing is allowed to improve clarity
-            - Avoid literal English word order
-            - Avoid Russian-style constructions
-            
-            OUTPUT RULES:
-            - Output ONLY Ukrainian
-            - No English
-            - No explanations
-            - No quotes
-            
-            TEXT:
-            {text}
-            """
-            
-        else:
-            prompt = f"""
-            You are a professional medical translator.
-            
-            TASK:
-            Translate the following medical text into **{target_language_name}**.
-            
-            STRICT RULES:
-            - Output MUST be written entirely in {target_language_name}
-            - DO NOT keep English sentences
-            - Medical terms may remain Latin-based if appropriate
-            - Do NOT summarize or paraphrase
-            - If unsure, still translate
-            - DO NOT write in English
-            
-            TEXT:
-            {text}
-            """
-        
-        response = client.chat.completions.create(
+        instructions = _gpt_translation_instructions(target_language_name, target_language_code)
+
+        translated = _chat_completion_text(
             model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
+            messages=[
+                {"role": "system", "content": instructions},
+                {"role": "user", "content": text},
+            ],
             temperature=0
-        )
-        translated = response.choices[0].message.content.strip()
+        ).strip()
 
         # 🔎 Post-check: still looks English?
         if _looks_english(translated):
@@ -141,7 +305,7 @@ def safe_translate(text, target_language_name):
         return translated
     except Exception:
         pass
-        
+
     try:
         translated = translator.translate(text, dest=target_language_name)
         return translated.text if translated else text
@@ -150,6 +314,283 @@ def safe_translate(text, target_language_name):
 
     return text
 
+async def _safe_translate_async(text, target_language_name, semaphore):
+    """Async counterpart of safe_translate, used when many texts are translated at once."""
+    if not text or not text.strip():
+        return text
+    if target_language_code == "en":
+        return text
+    try:
+        instructions = _gpt_translation_instructions(target_language_name, target_language_code)
+
+        async with semaphore:
+            response = await _achat_completion(
+                model="gpt-4o-mini",
+                messages=[
+                    {"role": "system", "content": instructions},
+                    {"role": "user", "content": text},
+                ],
+                temperature=0
+            )
+        translated = response.choices[0].message.content.strip()
+
+        if _looks_english(translated):
+            raise ValueError("GPT returned English")
+
+        return translated
+    except Exception:
+        pass
+
+    try:
+        # Run the googletrans fallback in a worker thread so concurrent
+        # translations keep overlapping instead of serializing on the loop.
+        translated = await asyncio.to_thread(translator.translate, text, dest=target_language_name)
+        return translated.text if translated else text
+    except Exception:
+        pass
+
+    return text
+
+def batch_translate(texts, target_language_name):
+    """Translate a list of strings in ONE GPT call, preserving order.
+
+    Falls back to the concurrent per-string path if the returned array does
+    not line up with the input.
+    """
+    texts = list(texts)
+    if target_language_code == "en" or not texts:
+        return texts
+    try:
+        instructions = (
+            f"Translate every item of the user's JSON array into {target_language_name}. "
+            "Keep medical terminology natural for clinicians. "
+            'Return ONLY a JSON object {"items": [...]} with the translations '
+            "in the same order and of the same length."
+        )
+        raw = _chat_completion_text(
+            model="gpt-4o-mini",
+            messages=[
+                {"role": "system", "content": instructions},
+                {"role": "user", "content": json.dumps(texts)},
+            ],
+            temperature=0,
+            response_format={"type": "json_object"}
+        )
+        items = _parse_json_items(raw)
+        if len(items) == len(texts):
+            return [str(item) for item in items]
+    except Exception:
+        pass
+    return translate_many(texts, target_language_name)
+
+def translate_many(texts, target_language_name):
+    """Translate a list of texts concurrently, bounded by a semaphore to respect rate limits."""
+    async def _gather():
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_OPENAI_CALLS)
+        return await asyncio.gather(
+            *[_safe_translate_async(t, target_language_name, semaphore) for t in texts]
+        )
+    try:
+        return list(asyncio.run(_gather()))
+    except Exception:
+        return [safe_translate(t, target_language_name) for t in texts]
+
+# -------------------------------
+# SEMANTIC RESPONSE CACHE (EMBEDDING SIMILARITY)
+# -------------------------------
+SEMANTIC_CACHE_THRESHOLD = 0.92
+
+EMBEDDING_TOKEN_LIMIT = 8000  # text-embedding-3-small accepts 8191 input tokens
+
+def _embed_prompt(prompt):
+    """Embed a prompt for cache lookup, truncated token-accurately to the model limit.
+
+    A character slice either wastes the token budget or splits a multi-byte
+    codepoint; slicing the token list from the cached encoder does neither.
+    """
+    enc = _get_encoding()
+    tokens = enc.encode_ordinary(prompt)
+    if len(tokens) > EMBEDDING_TOKEN_LIMIT:
+        prompt = enc.decode(tokens[:EMBEDDING_TOKEN_LIMIT])
+
+    # Identical text embeds identically: serve repeats from the disk cache
+    prompt_hash = _text_hash(prompt)
+    try:
+        row = _translation_cache_db().execute(
+            "SELECT vector FROM embeddings WHERE text_hash = ?", (prompt_hash,)
+        ).fetchone()
+        if row:
+            return np.frombuffer(row[0], dtype=np.float32)
+    except Exception:
+        pass
+
+    response = _create_embedding(model="text-embedding-3-small", input=prompt)
+    vector = np.asarray(response.data[0].embedding, dtype=np.float32)
+    try:
+        db = _translation_cache_db()
+        db.execute(
+            "INSERT OR REPLACE INTO embeddings (text_hash, vector) VALUES (?, ?)",
+            (prompt_hash, vector.tobytes())
+        )
+        db.commit()
+    except Exception:
+        pass
+    return vector
+
+def semantic_cache_get(prompt):
+    """Return (query_vector, cached_response) for a semantically equivalent prior prompt.
+
+    cached_response is None on a miss; query_vector is reused by
+    semantic_cache_put so the embedding is only computed once per call.
+    Cached vectors are unit-normalized at insert, so the lookup is a single
+    matrix-vector product over the whole store instead of a Python loop.
+    """
+    try:
+        query = np.asarray(_embed_prompt(prompt), dtype=np.float32)
+    except Exception:
+        return None, None
+    query /= np.linalg.norm(query)
+    matrix = st.session_state.get("sem_cache_matrix")
+    entries = st.session_state.get("sem_cache_entries", [])
+    if matrix is not None and entries:
+        sims = matrix @ query
+        best = int(sims.argmax())
+        if float(sims[best]) > SEMANTIC_CACHE_THRESHOLD:
+            return query, entries[best]
+    return query, None
+
+def semantic_cache_put(query_vector, response):
+    if query_vector is None:
+        return
+    matrix = st.session_state.get("sem_cache_matrix")
+    row = query_vector[None, :]
+    st.session_state["sem_cache_matrix"] = row if matrix is None else np.vstack([matrix, row])
+    st.session_state.setdefault("sem_cache_entries", []).append(response)
+
+# -------------------------------
+# PERSISTENT TRANSLATION CACHE (SURVIVES RESTARTS)
+# -------------------------------
+TRANSLATION_CACHE_PATH = os.path.join(tempfile.gettempdir(), "pdf2sa_translations.sqlite3")
+
+@st.cache_resource(show_spinner=False)
+def _translation_cache_db():
+    """sqlite connection for the on-disk translation cache, shared across sessions."""
+    conn = sqlite3.connect(TRANSLATION_CACHE_PATH, check_same_thread=False)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS translations ("
+        "text_hash TEXT, lang TEXT, translated TEXT, "
+        "PRIMARY KEY (text_hash, lang))"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS llm_responses ("
+        "request_hash TEXT PRIMARY KEY, response TEXT, created REAL)"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS embeddings ("
+        "text_hash TEXT PRIMARY KEY, vector BLOB)"
+    )
+    return conn
+
+def _text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def _cached_translation_get(text, lang):
+    try:
+        row = _translation_cache_db().execute(
+            "SELECT translated FROM translations WHERE text_hash = ? AND lang = ?",
+            (_text_hash(text), lang)
+        ).fetchone()
+        return row[0] if row else None
+    except Exception:
+        return None
+
+def _cached_translation_put(text, lang, translated):
+    try:
+        db = _translation_cache_db()
+        db.execute(
+            "INSERT OR REPLACE INTO translations (text_hash, lang, translated) VALUES (?, ?, ?)",
+            (_text_hash(text), lang, translated)
+        )
+        db.commit()
+    except Exception:
+        pass
+
+# -------------------------------
+# STATIC UI LABELS (BATCH TRANSLATED)
+# -------------------------------
+UI_STRINGS = [
+    "📄 Upload a PDF file",
+    "✅ PDF uploaded successfully!",
+    "🧩 Step 1: Generate Short-Answer Questions",
+    "Number of questions to generate:",
+    "⚡ Generate Questions",
+    "Generating questions... please wait",
+    "Questions generated. Translating...",
+    "✅ Done! Questions ready.",
+    "🧠 Step 2: Answer the Questions",
+    "🎤 Dictate your answer (you can record multiple times):",
+    "This recording was already transcribed.",
+    "🎧 Dictation appended to your answer.",
+    "⚠️ Transcription returned empty text.",
+    "✏️ Your Answer:",
+    "🚀 Evaluate My Answers",
+    "Evaluating your answers...",
+    "Receiving feedback...",
+    "✅ Evaluation complete!",
+    "Total Score",
+    "📊 Detailed Feedback",
+    "📚 Topics Covered So Far",
+    "📚 Retry Previous Question Sets",
+    "No previous question sets available.",
+    "Select a previous question set to view:",
+    "📄 Preview Selected Question Set",
+    "📂 Load Selected Question Set",
+    "🔄 Generate a New Set of Questions",
+    "Thank you for trying this multilingual short answer question generator! Please click on the following links to provide feedback to help improve this tool:",
+    "Feedback form for instructors:",
+    "Feedback form for students:",
+]
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def build_ui_translation_table(target_language_name, target_language_code):
+    """Translate all static UI labels in ONE googletrans call and return an {english: translated} dict."""
+    if target_language_code == "en":
+        return {}
+
+    # Warm start: serve the whole table from the on-disk cache, no network at all
+    cached = {s: _cached_translation_get(s, target_language_code) for s in UI_STRINGS}
+    if all(cached.values()):
+        return cached
+
+    try:
+        joined = "\n".join(UI_STRINGS)
+        translated = translator.translate(joined, dest=target_language_name)
+        if translated and hasattr(translated, "text"):
+            parts = translated.text.split("\n")
+            if len(parts) == len(UI_STRINGS):
+                table = dict(zip(UI_STRINGS, parts))
+                for en, tr in table.items():
+                    _cached_translation_put(en, target_language_code, tr)
+                return table
+    except Exception:
+        pass
+
+    # Join-split was unsafe (the translator added or dropped line breaks) —
+    # fall back to threaded per-label calls so the round trips still overlap.
+    try:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            parts = list(executor.map(
+                lambda s: translator.translate(s, dest=target_language_name).text,
+                UI_STRINGS
+            ))
+        table = dict(zip(UI_STRINGS, parts))
+        for en, tr in table.items():
+            _cached_translation_put(en, target_language_code, tr)
+        return table
+    except Exception:
+        pass
+    return {}
+
 #Google translate first
 def ui_translate(text, target_language_name):
     """Translate text safely with fallback to ChatGPT and skip English."""
@@ -157,9 +598,21 @@ def ui_translate(text, target_language_name):
         return text
     if target_language_code == "en":
         return text
+
+    # ✅ Static labels come from the batched table (one network call per language)
+    table = build_ui_translation_table(target_language_name, target_language_code)
+    if text in table:
+        return table[text]
+
+    # Dynamic strings repeat across reruns too — check the disk cache first
+    cached = _cached_translation_get(text, target_language_code)
+    if cached is not None:
+        return cached
+
     try:
         translated = translator.translate(text, dest=target_language_name)
         if translated and hasattr(translated, "text"):
+            _cached_translation_put(text, target_language_code, translated.text)
             return translated.text
     except Exception:
         pass
@@ -167,12 +620,13 @@ def ui_translate(text, target_language_name):
     try:
         prompt = f"""Translate this text into {target_language_name}:\n{text}"""
         
-        response = client.chat.completions.create(
+        translated = _chat_completion_text(
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": prompt}],
             temperature=0
-        )
-        return response.choices[0].message.content.strip()    
+        ).strip()
+        _cached_translation_put(text, target_language_code, translated)
+        return translated
     except Exception:
         pass
     return text
@@ -311,16 +765,71 @@ def bilingual_text_ui(en_text):
 # -------------------------------
 uploaded_file = st.file_uploader(bilingual_text_ui("📄 Upload a PDF file"), type=["pdf"])
 
-def extract_text_from_pdf(uploaded_file):
-    text = ""
-    with fitz.open(stream=uploaded_file.read(), filetype="pdf") as pdf_doc:
-        for page in pdf_doc:
-            text += page.get_text("text")
-    return text
-    
+# Precompiled cleanup patterns: page-number-only lines, soft hyphens, and
+# line-break hyphenation, all stripped in one pass each before chunking.
+_PAGE_NUMBER_LINE_RE = re.compile(r"\n\s*\d+\s*\n")
+_HYPHEN_BREAK_RE = re.compile(r"-\n|\u00ad")
+
+def _clean_pdf_text(text):
+    """Remove extraction artifacts that waste prompt tokens."""
+    text = _HYPHEN_BREAK_RE.sub("", text)
+    return _PAGE_NUMBER_LINE_RE.sub("\n", text)
+
+def _extract_pages_fitz(path, start, end):
+    """Extract a page range with a private document handle.
+
+    MuPDF is not thread-safe on a shared document, so each worker opens the
+    file itself; the OS page cache makes the extra opens cheap.
+    """
+    with fitz.open(path) as doc:
+        return "\n".join(
+            doc.load_page(i).get_text("text", flags=fitz.TEXT_DEHYPHENATE)
+            for i in range(start, end)
+        )
+
+@st.cache_data(show_spinner=False)
+def extract_text_from_pdf(file_name, file_size, _uploaded_file):
+    """Extract text from an uploaded PDF. Cached so reruns skip re-parsing the same file.
+
+    The upload is spooled to a temp file in 1MB pieces so MuPDF can mmap it,
+    instead of materializing the whole PDF as a bytes object in RAM. The cache
+    key is (file_name, file_size), which is O(1) to hash regardless of PDF size.
+    """
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp_file:
+        _uploaded_file.seek(0)
+        shutil.copyfileobj(_uploaded_file, tmp_file, length=1 << 20)
+        tmp_path = tmp_file.name
+    try:
+        if pdfium is not None:
+            pdf_doc = pdfium.PdfDocument(tmp_path)
+            try:
+                text = "\n".join(page.get_textpage().get_text_range() for page in pdf_doc)
+            finally:
+                pdf_doc.close()
+        else:
+            with fitz.open(tmp_path) as pdf_doc:
+                page_count = pdf_doc.page_count
+            if page_count >= 16:
+                # Long document: extract page ranges in parallel, one document
+                # handle per worker. get_text releases the GIL inside MuPDF.
+                workers = min(os.cpu_count() or 1, 4)
+                step = -(-page_count // workers)
+                ranges = [(i, min(i + step, page_count)) for i in range(0, page_count, step)]
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    parts = list(executor.map(lambda r: _extract_pages_fitz(tmp_path, r[0], r[1]), ranges))
+                text = "\n".join(parts)
+            else:
+                with fitz.open(tmp_path) as pdf_doc:
+                    text = "\n".join(
+                        page.get_text("text", flags=fitz.TEXT_DEHYPHENATE) for page in pdf_doc
+                    )
+    finally:
+        os.remove(tmp_path)
+    return _clean_pdf_text(text)
+
 if uploaded_file:
     if "pdf_text" not in st.session_state or st.session_state.get("uploaded_file_name") != uploaded_file.name:
-        pdf_text = extract_text_from_pdf(uploaded_file)
+        pdf_text = extract_text_from_pdf(uploaded_file.name, uploaded_file.size, uploaded_file)
         st.session_state["pdf_text"] = pdf_text
         st.session_state["uploaded_file_name"] = uploaded_file.name
         st.success(bilingual_text_ui("✅ PDF uploaded successfully!"))
@@ -339,19 +848,18 @@ def extract_topics_from_questions(questions):
     """
     prompt = f"""
 Extract a concise topic label (2–5 words) for each of the following oral board questions.
-Return ONLY a JSON list of UNIQUE topic strings.
+Return ONLY a JSON object: {{"items": ["unique topic string", ...]}}
 
 QUESTIONS:
-{json.dumps([q["question_en"] for q in questions], indent=2)}
+{json.dumps([q["question_en"] for q in questions], separators=(",", ":"))}
 """
-    response = client.chat.completions.create(
+    raw = _chat_completion_text(
         model="gpt-4o-mini",
         messages=[{"role": "user", "content": prompt}],
-        temperature=0
+        temperature=0,
+        response_format={"type": "json_object"}
     )
-    raw = response.choices[0].message.content.strip()
-    raw = re.sub(r"```(?:json)?|```", "", raw).strip()
-    return json.loads(raw)
+    return _parse_json_items(raw)
 
 
 def get_used_topics():
@@ -364,6 +872,113 @@ def get_used_topics():
             used.add(t)
     return sorted(list(used))
 
+# -------------------------------
+# PDF CHUNKING FOR QUESTION GENERATION
+# -------------------------------
+CHUNK_TOKEN_LIMIT = 6000  # source tokens per generation call
+
+@st.cache_resource(show_spinner=False)
+def _get_encoding():
+    """Load the cl100k_base BPE table once per process; it is expensive to build."""
+    return tiktoken.get_encoding("cl100k_base")
+
+def split_text_into_chunks(text, max_tokens=CHUNK_TOKEN_LIMIT):
+    """Split PDF text into generation-sized chunks of at most max_tokens tokens.
+
+    The document is tokenized once and the token list sliced into fixed-size
+    windows, so chunking stays linear in document length instead of re-encoding
+    a growing buffer."""
+    enc = _get_encoding()
+    tokens = enc.encode_ordinary(text)
+    if len(tokens) <= max_tokens:
+        return [text]
+    return [enc.decode(tokens[i:i + max_tokens]) for i in range(0, len(tokens), max_tokens)]
+
+def _question_generation_messages(source_text, n_questions, used_topics, target_language_name=None):
+    """Build the question-generation messages for one piece of source text.
+
+    All static instructions live in the system message so repeated calls share
+    an identical prefix and hit OpenAI's server-side prompt cache; only the
+    per-call payload (count, used topics, source text) goes in the user turn,
+    with the source text last. For non-English targets the instructions ask
+    for the translated question and answer key in the same response, so no
+    second translation call is needed.
+    """
+    bilingual_fields = ""
+    bilingual_rule = ""
+    if target_language_name and target_language_name != "English":
+        bilingual_fields = f', "question_translated": "string ({target_language_name})", "answer_key_translated": "string ({target_language_name})"'
+        bilingual_rule = f"""
+    - For EACH item also return "question_translated" and "answer_key_translated": the question and answer key written in natural, clinically correct {target_language_name} (keep common English/Latin medical terms where usual)."""
+    system_prompt = f"""
+    You are an expert medical educator.
+    Generate the requested number of concise short-answer questions and their answer keys based on the source content.
+    Your target audience is residents.
+
+    TASK:
+    1. Identify ALL major topics in the source material.
+    2. Exclude any previously used topics listed in the request.
+    3. Randomly select the requested number of DIFFERENT remaining topics.
+    4. Write ONE concise short-answer question per topic, structured like a Royal College of Physicians and Surgeons oral boards exam.
+
+    RULES:
+    - Ensure the questions are **proportional across the manual**, covering all major topics.
+    - Each question must test a DIFFERENT topic
+    - Do NOT generate multiple questions from the same subsection
+    - Do NOT follow the order of the manual
+    - Do NOT repeat themes from earlier question sets
+    - Focus on clinical relevance
+    - If surgical content exists, include presentation, approach, and management
+    - Questions should resemble Royal College oral board style{bilingual_rule}
+
+    Return ONLY a JSON object in this format:
+    {{"items": [
+      {{"topic": "string", "question": "string", "answer_key": "string", "rubric": ["key point 1", "key point 2"]{bilingual_fields}}}
+    ]}}
+    """
+    user_prompt = f"""
+    NUMBER OF QUESTIONS: {n_questions}
+    PREVIOUSLY USED TOPICS (avoid these unless no alternatives remain): {json.dumps(used_topics, separators=(",", ":"))}
+
+    SOURCE TEXT:
+    {source_text}
+    """
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt},
+    ]
+
+def generate_questions_over_chunks(chunks, num_questions, used_topics, target_language_name=None):
+    """Generate questions from every chunk concurrently and sample down to num_questions.
+
+    Each chunk's share of the question budget is proportional to its length
+    (with a floor of one), all calls run under the shared semaphore, and the
+    flattened pool is sampled so the final set covers the whole document
+    instead of just its beginning.
+    """
+    total_len = sum(len(c) for c in chunks)
+    quotas = [max(1, round(num_questions * len(c) / total_len)) for c in chunks]
+
+    async def _gather():
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_OPENAI_CALLS)
+
+        async def _gen(chunk, quota):
+            async with semaphore:
+                response = await _achat_completion(
+                    model="gpt-4.1-mini-2025-04-14",
+                    messages=_question_generation_messages(chunk, quota, used_topics, target_language_name),
+                    temperature=0.8,
+                    response_format={"type": "json_object"}
+                )
+            return _parse_json_items(response.choices[0].message.content)
+
+        return await asyncio.gather(*[_gen(c, q) for c, q in zip(chunks, quotas)])
+
+    pooled = [item for part in asyncio.run(_gather()) for item in part]
+    if len(pooled) > num_questions:
+        pooled = random.sample(pooled, num_questions)
+    return pooled
+
 # -------------------------------
 # QUESTION GENERATION (Single GPT Call, Bilingual, Previous Sets)
 # -------------------------------
@@ -390,52 +1005,42 @@ if pdf_text:
         # 1️⃣ Prompt GPT to generate all questions
         # -------------------------------
         used_topics = get_used_topics()
-        prompt = f"""
-    You are an expert medical educator.
-    Generate {num_questions} concise short-answer questions and their answer keys based on the following content.
-    PREVIOUSLY USED TOPICS (avoid these unless no alternatives remain): {json.dumps(used_topics, indent=2)}
-    Your target audience is residents.
-    
-    TASK:
-    1. Identify ALL major topics in the source material.
-    2. Exclude any topics listed above.
-    3. Randomly select {num_questions} DIFFERENT remaining topics.
-    4. Write ONE concise short-answer question per topic, structured like a Royal College of Physicians and Surgeons oral boards exam.
-    
-    RULES:
-    - Ensure the questions are **proportional across the manual**, covering all major topics.
-    - Each question must test a DIFFERENT topic
-    - Do NOT generate multiple questions from the same subsection
-    - Do NOT follow the order of the manual
-    - Do NOT repeat themes from earlier question sets
-    - Focus on clinical relevance
-    - If surgical content exists, include presentation, approach, and management
-    - Questions should resemble Royal College oral board style
-    
-    Return ONLY JSON in this format:
-    [
-      {{"topic": "string", "question": "string", "answer_key": "string"}}
-    ]
-    
-    SOURCE TEXT:
-    {pdf_text}
-    """
+        chunks = split_text_into_chunks(pdf_text)
         try:
-            response = client.chat.completions.create(
-                model="gpt-4.1-mini-2025-04-14",
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.8
-            )
-            raw = response.choices[0].message.content.strip()
-            raw = re.sub(r"```(?:json)?|```", "", raw).strip()
-            all_items = json.loads(raw)
+            if len(chunks) > 1:
+                # Large document: generate per chunk concurrently so the whole
+                # manual is covered without multiplying wall-clock time.
+                all_items = generate_questions_over_chunks(chunks, num_questions, used_topics, target_language_name)
+            else:
+                # Stream the completion so the progress bar moves while tokens
+                # arrive, instead of sitting still until the full response lands.
+                stream = _chat_completion(
+                    model="gpt-4.1-mini-2025-04-14",
+                    messages=_question_generation_messages(pdf_text, num_questions, used_topics, target_language_name),
+                    temperature=0.8,
+                    response_format={"type": "json_object"},
+                    stream=True
+                )
+                raw_parts = []
+                for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        raw_parts.append(chunk.choices[0].delta.content)
+                        if len(raw_parts) % 25 == 0:
+                            progress.progress(
+                                min(5 + len(raw_parts) // 25, 45),
+                                text=bilingual_text_ui("Generating questions... please wait")
+                            )
+                all_items = _parse_json_items("".join(raw_parts).strip())
     
             # Normalize structure
             all_questions = [
                 {
                     "topic": item.get("topic", "").strip(),
                     "question": item.get("question", "").strip(),
-                    "answer_key": item.get("answer_key", "").strip()
+                    "answer_key": item.get("answer_key", "").strip(),
+                    "rubric": item.get("rubric", []),
+                    "question_translated": item.get("question_translated", "").strip(),
+                    "answer_key_translated": item.get("answer_key_translated", "").strip()
                 }
                 for item in all_items
                 if item.get("question") and item.get("answer_key")
@@ -457,7 +1062,18 @@ if pdf_text:
                 for q in all_questions:
                     bilingual_questions.append({
                         "question_en": q.get("question", ""),
-                        "answer_key_en": q.get("answer_key", "")
+                        "answer_key_en": q.get("answer_key", ""),
+                        "rubric_en": q.get("rubric", [])
+                    })
+            elif all(q.get("question_translated") and q.get("answer_key_translated") for q in all_questions):
+                # Translations came back inline with generation — no second call
+                for q in all_questions:
+                    bilingual_questions.append({
+                        "question_en": q.get("question", ""),
+                        "answer_key_en": q.get("answer_key", ""),
+                        "rubric_en": q.get("rubric", []),
+                        "question_translated": q.get("question_translated", ""),
+                        "answer_key_translated": q.get("answer_key_translated", "")
                     })
             else:
                 # Prepare batch text for GPT translation to minimize API calls
@@ -494,9 +1110,10 @@ if pdf_text:
                     - No explanations
                     - No quotes
                     
-                    Return JSON in the same order with this format: [
-                                    {{"question_translated": "string", "answer_key_translated": "string"}}
-                                    ]
+                    Return a JSON object in the same order with this format:
+                    {{"items": [
+                    {{"question_translated": "string", "answer_key_translated": "string"}}
+                    ]}}
                                     
                     TEXT:
                     {batch_text}
@@ -516,23 +1133,22 @@ if pdf_text:
                     - If unsure, still translate
                     - DO NOT write in English
                     
-                    Return JSON in the same order with this format:
-                    [
+                    Return a JSON object in the same order with this format:
+                    {{"items": [
                     {{"question_translated": "string", "answer_key_translated": "string"}}
-                    ]
+                    ]}}
                     
                     TEXT:
                     {batch_text}
                     """
                 try:
-                    translation_resp = client.chat.completions.create(
+                    raw_trans = _chat_completion_text(
                         model="gpt-4o-mini",
                         messages=[{"role": "user", "content": translation_prompt}],
-                        temperature=0
+                        temperature=0,
+                        response_format={"type": "json_object"}
                     )
-                    raw_trans = translation_resp.choices[0].message.content.strip()
-                    raw_trans = re.sub(r"```(?:json)?|```", "", raw_trans).strip()
-                    translations = json.loads(raw_trans)
+                    translations = _parse_json_items(raw_trans)
                     
                 except Exception:
                     translations = [{}] * len(all_questions)
@@ -541,6 +1157,7 @@ if pdf_text:
                     bilingual_questions.append({
                         "question_en": q.get("question", ""),
                         "answer_key_en": q.get("answer_key", ""),
+                        "rubric_en": q.get("rubric", []),
                         "question_translated": t.get("question_translated", ""),
                         "answer_key_translated": t.get("answer_key_translated", "")
                     })
@@ -573,6 +1190,75 @@ if pdf_text:
             st.session_state["current_set_id"] = new_set_id
             st.success(bilingual_text_ui(f"Generated {len(bilingual_questions)} representative questions successfully!"))
 
+# -------------------------------
+# EVALUATION PROMPT TEMPLATE (BUILT ONCE AT IMPORT)
+# -------------------------------
+GRADING_RESPONSE_SCHEMA = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "grading",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "items": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "score": {"type": "integer"},
+                            "feedback": {"type": "string"},
+                            "model_answer": {"type": "string"},
+                        },
+                        "required": ["score", "feedback", "model_answer"],
+                        "additionalProperties": False,
+                    },
+                }
+            },
+            "required": ["items"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+# Static examiner instructions: kept in the system message so every grading
+# call shares an identical prefix for OpenAI's server-side prompt cache.
+GRADING_SYSTEM_PROMPT = """
+    You are a supportive Royal College oral boards examiner assessing RESIDENT-LEVEL answers.
+    
+    Your goal is to fairly assess clinical understanding, not to fail candidates.
+    
+    IMPORTANT GRADING PHILOSOPHY:
+    - Full marks (9–10/10) are achievable for clear, correct, resident-appropriate answers
+    - Do NOT require consultant-level depth for full credit
+    - Award generous partial credit for correct core concepts
+    - Minor omissions or wording issues should NOT heavily penalize the score
+    - Answers may be brief, non-native English, or in another language
+    
+    SCORING RUBRIC (0–10):
+    - 9–10: Correct core concepts, clinically sound, safe management; minor details may be missing
+    - 7–8: Mostly correct with good understanding; some gaps or imprecision
+    - 5–6: Partial understanding; correct ideas but important omissions
+    - 3–4: Limited understanding; some correct fragments
+    - 1–2: Minimal understanding
+    - 0: Unsafe or completely incorrect
+    
+    INSTRUCTIONS:
+    1. Focus on whether the candidate demonstrates SAFE and CORRECT clinical reasoning
+    2. Compare the response to the expected answer key and rubric, but do NOT require exact wording
+    3. If the core idea is present, award at least 6/10
+    4. Be especially fair to concise answers typical of oral exams
+    
+    Return ONLY a JSON object:
+    {"items": [
+      {
+        "score": 0,
+        "feedback": "Brief, constructive feedback explaining the score.",
+        "model_answer": "A concise ideal resident-level answer, based on the expected answer key and rubric (do NOT invent new content)."
+      }
+    ]}
+    """
+
 # -------------------------------
 # USER ANSWERS (WITH AUDIO INPUT)
 # -------------------------------
@@ -616,19 +1302,9 @@ if st.session_state["questions"]:
                 if st.session_state.get(last_hash_key) == audio_hash:
                     st.info(bilingual_text_ui("This recording was already transcribed."), icon="ℹ️")
                 else:
-                    with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as tmp_file:
-                        tmp_file.write(audio_bytes)
-                        tmp_path = tmp_file.name
-        
-                    with open(tmp_path, "rb") as f:
-                        transcription = client.audio.transcriptions.create(
-                            model="whisper-1",
-                            file=f
-                        )
-        
-                    os.remove(tmp_path)
-        
-                    dictated_text = getattr(transcription, "text", "").strip()
+                    # The SDK accepts (filename, bytes, mime) directly — no
+                    # temp-file round trip on disk needed.
+                    dictated_text = transcribe_audio(audio_hash, audio_bytes)
         
                     if dictated_text:
                         # ✅ Append to CURRENT text area value
@@ -651,16 +1327,12 @@ if st.session_state["questions"]:
 
         label = bilingual_text_ui("✏️ Your Answer:")
         key = f"ans_{qid}_{i}"  # unified key
-        existing_text = st.session_state.get(key, "").strip()
-        if existing_text:
-            new_text = f"{existing_text} {dictated_text}"
-        else:
-            new_text = dictated_text
-        
-        st.session_state[key] = new_text
-        st.session_state["user_answers"][i] = new_text
-        
+        # The transcription block above already appended the dictation into
+        # st.session_state[key] BEFORE this widget instantiates, so the text
+        # area shows the new value on the same run — no rerun and no second
+        # append needed here.
         current_text = st.text_area(label, height=80, key=key)
+        st.session_state["user_answers"][i] = current_text
 
     user_answers = st.session_state.get("user_answers", [])
 
@@ -668,63 +1340,52 @@ if st.session_state["questions"]:
     # EVALUATION
     # -------------------------------
     def score_short_answers(user_answers, questions):
-        grading_prompt = f"""
-        You are a supportive Royal College oral boards examiner assessing RESIDENT-LEVEL answers.
-        
-        Your goal is to fairly assess clinical understanding, not to fail candidates.
-        
-        IMPORTANT GRADING PHILOSOPHY:
-        - Full marks (9–10/10) are achievable for clear, correct, resident-appropriate answers
-        - Do NOT require consultant-level depth for full credit
-        - Award generous partial credit for correct core concepts
-        - Minor omissions or wording issues should NOT heavily penalize the score
-        - Answers may be brief, non-native English, or in another language
-        
-        SCORING RUBRIC (0–10):
-        - 9–10: Correct core concepts, clinically sound, safe management; minor details may be missing
-        - 7–8: Mostly correct with good understanding; some gaps or imprecision
-        - 5–6: Partial understanding; correct ideas but important omissions
-        - 3–4: Limited understanding; some correct fragments
-        - 1–2: Minimal understanding
-        - 0: Unsafe or completely incorrect
-        
-        INSTRUCTIONS:
-        1. Focus on whether the candidate demonstrates SAFE and CORRECT clinical reasoning
-        2. Compare the response to the expected answer key, but do NOT require exact wording
-        3. If the core idea is present, award at least 6/10
-        4. Be especially fair to concise answers typical of oral exams
-        
-        Return ONLY JSON:
-        [
-          {{
-            "score": 0,
-            "feedback": "Brief, constructive feedback explaining the score.",
-            "model_answer": "A concise ideal resident-level answer."
-          }}
-        ]
-        
-        QUESTIONS AND RESPONSES:
-        {json.dumps([
+        # Only the per-submission payload varies; it goes last, in the user turn.
+        # Compact separators and generous field caps keep the prompt small —
+        # whitespace and runaway answers are pure token cost to the grader.
+        grading_payload = "QUESTIONS AND RESPONSES:\n" + json.dumps([
             {
                 "question": q.get("question_en", ""),
-                "expected": q.get("answer_key_en", ""),
-                "response": a
+                "expected": q.get("answer_key_en", "")[:800],
+                "rubric": q.get("rubric_en", []),
+                "response": a[:1500]
             }
             for q, a in zip(questions, user_answers)
-        ], indent=2)}
-        """
+        ], separators=(",", ":"))
         try:
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "user", "content": grading_prompt}],
-                temperature=0
-            )
-            raw = response.choices[0].message.content.strip()
-            raw = re.sub(r"```(?:json)?|```", "", raw).strip()
-            results = json.loads(raw)
+            query_vector, cached_results = semantic_cache_get(grading_payload)
+            if cached_results is not None:
+                results = cached_results
+            else:
+                status = st.empty()
+                receiving_label = bilingual_text_ui("Receiving feedback...")
+
+                def _on_delta(buffer):
+                    status.caption(f"{receiving_label} ({len(buffer)})")
+
+                raw_grading = _chat_completion_text(
+                    on_delta=_on_delta,
+                    model="gpt-4o-mini",
+                    messages=[
+                        {"role": "system", "content": GRADING_SYSTEM_PROMPT},
+                        {"role": "user", "content": grading_payload},
+                    ],
+                    temperature=0,
+                    response_format=GRADING_RESPONSE_SCHEMA
+                )
+                status.empty()
+                results = _parse_json_items(raw_grading)
+                semantic_cache_put(query_vector, results)
+
+            # Translate all feedback + model answers concurrently instead of one by one
+            texts_to_translate = []
             for r in results:
-                r["feedback_translated"] = safe_translate(r.get("feedback", ""), target_language_name)
-                r["model_answer_translated"] = safe_translate(r.get("model_answer", ""), target_language_name)
+                texts_to_translate.append(r.get("feedback", ""))
+                texts_to_translate.append(r.get("model_answer", ""))
+            translated = batch_translate(texts_to_translate, target_language_name)
+            for r, feedback_tr, model_answer_tr in zip(results, translated[0::2], translated[1::2]):
+                r["feedback_translated"] = feedback_tr
+                r["model_answer_translated"] = model_answer_tr
             return results
         except Exception as e:
             st.error(bilingual_text_ui(f"⚠️ Scoring failed: {e}"))